@@ -2,22 +2,126 @@
 # https://alembic.sqlalchemy.org/en/latest/tutorial.html#creating-an-environment
 
 import contextlib
-from typing import Optional
+import io
+import sys
+from typing import Callable, Optional
 
+import anyio.from_thread
 import sqlalchemy
 from alembic import context
 from sqlalchemy.ext.asyncio import AsyncEngine
+from typing_extensions import TypeAlias
 
 from prefect.server.database.configurations import SQLITE_BEGIN_MODE
 from prefect.server.database.dependencies import provide_database_interface
 from prefect.server.utilities.database import get_dialect
-from prefect.utilities.asyncutils import run_async_from_worker_thread
+from prefect.utilities.asyncutils import (
+    run_async_from_worker_thread,
+    run_async_in_new_loop,
+)
 
 db_interface = provide_database_interface()
 config = context.config
 target_metadata = db_interface.Base.metadata
 dialect = get_dialect(db_interface.database_config.connection_url)
 
+# resolve the dialect once up front; `include_object` in particular is called once
+# per schema object during autogenerate
+_DIALECT_NAME: str = dialect.name
+_IS_SQLITE: bool = _DIALECT_NAME == "sqlite"
+_TEMPLATE_ARGS: dict[str, str] = {"dialect": _DIALECT_NAME}
+
+# index name patterns that `include_object` ignores, see `_handle_index`
+_FUNC_SUFFIXES: tuple[str, ...] = ("asc", "desc")
+_GIN_PREFIX: str = "gin"
+_CI_SUFFIX: str = "case_insensitive"
+
+_IncludeObjectHandler: TypeAlias = Callable[
+    [sqlalchemy.schema.SchemaItem, str, bool, Optional[sqlalchemy.schema.SchemaItem]],
+    bool,
+]
+
+
+def _dialect_excluded_indexes(
+    metadata: sqlalchemy.MetaData, dialect_name: str
+) -> frozenset[sqlalchemy.Index]:
+    """
+    Returns the indexes in `metadata` whose `.ddl_if(dialect=...)` metadata does not
+    match the given dialect.
+    """
+    excluded: set[sqlalchemy.Index] = set()
+    for table in metadata.tables.values():
+        for index in table.indexes:
+            if (ddl_if := index._ddl_if) is None or ddl_if.dialect is None:
+                continue
+            # `.ddl_if(dialect=...)` takes a single dialect name or a collection
+            # of them
+            if isinstance(ddl_if.dialect, str):
+                matches = dialect_name == ddl_if.dialect
+            else:
+                matches = dialect_name in ddl_if.dialect
+            if not matches:
+                excluded.add(index)
+    return frozenset(excluded)
+
+
+# the dialect is fixed for the lifetime of this module, so resolve which indexes are
+# gated out by `.ddl_if` once rather than on every `include_object` call
+_DIALECT_EXCLUDED_INDEXES: frozenset[sqlalchemy.Index] = _dialect_excluded_indexes(
+    target_metadata, _DIALECT_NAME
+)
+
+
+def _handle_index(
+    object: sqlalchemy.schema.SchemaItem,
+    name: str,
+    reflected: bool,
+    compare_to: Optional[sqlalchemy.schema.SchemaItem],
+) -> bool:
+    # because of the dynamic inheritance pattern used by the Prefect database,
+    # it is difficult to get alembic to resolve references to indexes on inherited models
+    #
+    # to keep autogenerated migration code clean, we ignore the following indexes:
+    # * functional indexes (ending in 'desc', 'asc'), if an index with the same name already exists
+    # * trigram indexes that already exist
+    # * case_insensitive indexes that already exist
+    # * indexes that don't yet exist but have .ddl_if(dialect=...) metadata that doesn't match
+    #   the current dialect.
+    if not reflected:
+        if name.endswith(_FUNC_SUFFIXES):
+            return compare_to is None or object.name != compare_to.name
+        if object in _DIALECT_EXCLUDED_INDEXES:
+            return False
+
+    else:  # reflected
+        if name.startswith(_GIN_PREFIX) or name.endswith(_CI_SUFFIX):
+            return False
+
+    return True
+
+
+def _handle_column(
+    object: sqlalchemy.schema.SchemaItem,
+    name: str,
+    reflected: bool,
+    compare_to: Optional[sqlalchemy.schema.SchemaItem],
+) -> bool:
+    # SQLite doesn't have an enum type, so reflection always comes back with
+    # a VARCHAR column, which doesn't match. Skip columns where the type
+    # doesn't match
+    if object.type.__visit_name__ == "enum" and compare_to is not None:
+        return compare_to.type.__visit_name__ == "enum"
+
+    return True
+
+
+# `include_object` dispatches on the object type; types without an entry here
+# ("table", "unique_constraint", "foreign_key_constraint", and "column" outside of
+# sqlite) are always included without any further checks
+_HANDLERS: dict[str, _IncludeObjectHandler] = {"index": _handle_index}
+if _IS_SQLITE:
+    _HANDLERS["column"] = _handle_column
+
 
 def include_object(
     object: sqlalchemy.schema.SchemaItem,
@@ -46,44 +150,11 @@ def include_object(
         bool: whether or not the specified object should be included in autogenerated
             migration code.
     """
+    handler = _HANDLERS.get(type_)
+    if handler is None:
+        return True
 
-    # because of the dynamic inheritance pattern used by the Prefect database,
-    # it is difficult to get alembic to resolve references to indexes on inherited models
-    #
-    # to keep autogenerated migration code clean, we ignore the following indexes:
-    # * functional indexes (ending in 'desc', 'asc'), if an index with the same name already exists
-    # * trigram indexes that already exist
-    # * case_insensitive indexes that already exist
-    # * indexes that don't yet exist but have .ddl_if(dialect=...) metadata that doesn't match
-    #   the current dialect.
-    if type_ == "index":
-        if not reflected:
-            if name.endswith(("asc", "desc")):
-                return compare_to is None or object.name != compare_to.name
-            if (ddl_if := object._ddl_if) is not None and ddl_if.dialect is not None:
-                desired: set[str] = (
-                    {ddl_if.dialect}
-                    if isinstance(ddl_if.dialect, str)
-                    else set(ddl_if.dialect)
-                )
-                return dialect.name in desired
-
-        else:  # reflected
-            if name.startswith("gin") or name.endswith("case_insensitive"):
-                return False
-
-    # SQLite doesn't have an enum type, so reflection always comes back with
-    # a VARCHAR column, which doesn't match. Skip columns where the type
-    # doesn't match
-    if (
-        dialect.name == "sqlite"
-        and type_ == "column"
-        and object.type.__visit_name__ == "enum"
-        and compare_to is not None
-    ):
-        return compare_to.type.__visit_name__ == "enum"
-
-    return True
+    return handler(object, name, reflected, compare_to)
 
 
 def dry_run_migrations() -> None:
@@ -96,9 +167,14 @@ def dry_run_migrations() -> None:
     url = db_interface.database_config.connection_url
     context.script.version_locations = [db_interface.orm.versions_dir]
 
+    # collect the rendered statements and write them out in one go rather than
+    # writing (and potentially flushing) each statement separately
+    output_buffer = io.StringIO()
+
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        output_buffer=output_buffer,
         literal_binds=True,
         include_schemas=True,
         include_object=include_object,
@@ -113,13 +189,22 @@ def dry_run_migrations() -> None:
         # table to the new one, then drop the old table.
         #
         # see https://alembic.sqlalchemy.org/en/latest/batch.html#batch-migrations
-        render_as_batch=dialect.name == "sqlite",
+        #
+        # Batch operations reflect the existing table to build the copy, which needs
+        # a live connection. For their SQL to be rendered in a dry run, the
+        # migration must pass the table definition instead, with
+        # `op.batch_alter_table(..., copy_from=...)`; this also skips the reflection
+        # queries when migrations are applied.
+        render_as_batch=_IS_SQLITE,
         # Each migration is its own transaction
         transaction_per_migration=True,
-        template_args={"dialect": dialect.name},
+        template_args=_TEMPLATE_ARGS,
     )
-    with context.begin_transaction():
-        context.run_migrations()
+    try:
+        with context.begin_transaction():
+            context.run_migrations()
+    finally:
+        (config.output_buffer or sys.stdout).write(output_buffer.getvalue())
 
 
 def do_run_migrations(connection: AsyncEngine) -> None:
@@ -133,6 +218,10 @@ def do_run_migrations(connection: AsyncEngine) -> None:
         connection=connection,
         target_metadata=target_metadata,
         include_schemas=True,
+        # `include_object` is only consulted when comparing the database against
+        # `target_metadata`, so applying migrations never calls it. It must stay
+        # configured here because `alembic revision --autogenerate` requires a
+        # live connection and therefore runs through this function.
         include_object=include_object,
         # Only use batch statements by default on sqlite
         #
@@ -144,10 +233,18 @@ def do_run_migrations(connection: AsyncEngine) -> None:
         # table to the new one, then drop the old table.
         #
         # see https://alembic.sqlalchemy.org/en/latest/batch.html#batch-migrations
-        render_as_batch=dialect.name == "sqlite",
-        # Each migration is its own transaction
-        transaction_per_migration=True,
-        template_args={"dialect": dialect.name},
+        render_as_batch=_IS_SQLITE,
+        # Each migration is its own transaction on postgres. On sqlite, all pending
+        # migrations are applied in a single transaction so that a chain of
+        # revisions commits (and syncs to disk) once instead of once per revision.
+        #
+        # Alembic assumes sqlite does not support transactional DDL, in which case
+        # `transaction_per_migration` has no effect, but our sqlite connections
+        # emit their own BEGIN (see `AioSqliteConfiguration.begin_sqlite_conn`) so
+        # DDL participates in the transaction as expected.
+        transactional_ddl=True,
+        transaction_per_migration=not _IS_SQLITE,
+        template_args=_TEMPLATE_ARGS,
     )
 
     # We override SQLAlchemy's handling of BEGIN on SQLite and Alembic bypasses our
@@ -165,19 +262,36 @@ def do_run_migrations(connection: AsyncEngine) -> None:
 def disable_sqlite_foreign_keys(context):
     """
     Disable foreign key constraints on sqlite.
+
+    Memory-mapped I/O is also enabled for the duration of the migrations, since
+    batch migrations copy entire tables on sqlite.
     """
-    if dialect.name == "sqlite":
+    mmap_size: Optional[int] = None
+    if _IS_SQLITE:
         context.execute("COMMIT")
         context.execute("PRAGMA foreign_keys=OFF")
-        context.execute("BEGIN IMMEDIATE")
 
-    yield
+        # `journal_mode`, `synchronous`, and `cache_size` are already configured for
+        # every connection in `AioSqliteConfiguration.setup_sqlite`. In-memory
+        # databases don't support memory-mapped I/O and return no row here.
+        mmap_size = context.get_bind().exec_driver_sql("PRAGMA mmap_size").scalar()
+        if mmap_size is not None:
+            context.execute("PRAGMA mmap_size=268435456")  # 256 MiB
 
-    if dialect.name == "sqlite":
-        context.execute("END")
-        context.execute("PRAGMA foreign_keys=ON")
         context.execute("BEGIN IMMEDIATE")
 
+    try:
+        yield
+    finally:
+        # restore the connection's settings even if a migration fails, since it
+        # will be returned to the pool
+        if _IS_SQLITE:
+            context.execute("END")
+            context.execute("PRAGMA foreign_keys=ON")
+            if mmap_size is not None:
+                context.execute(f"PRAGMA mmap_size={mmap_size}")
+            context.execute("BEGIN IMMEDIATE")
+
 
 async def apply_migrations() -> None:
     """
@@ -198,4 +312,11 @@ else:
     # does not cause this issue, but it is not clear why. The current working theory is
     # that running `apply_migrations` in another thread gives the migrations enough
     # isolation to avoid caching issues.
-    run_async_from_worker_thread(apply_migrations)
+    #
+    # Alembic commands invoked outside of an anyio worker thread (e.g. calling
+    # `alembic_upgrade` directly from synchronous code) have no event loop to hand
+    # the migrations off to, so they run in a new one instead.
+    if getattr(anyio.from_thread.threadlocals, "current_token", None) is not None:
+        run_async_from_worker_thread(apply_migrations)
+    else:
+        run_async_in_new_loop(apply_migrations)